@@ -1,19 +1,35 @@
-from torch.utils.data import Dataset
-import csv
-from nltk.tokenize import word_tokenize
+from torch.utils.data import Dataset, Sampler
+from torch.nn.utils.rnn import pad_sequence
+from collections import Counter
+from itertools import chain, repeat
+import re
 import numpy as np
+import pandas as pd
+import pyarrow as pa
+from pyarrow import feather
 import torch
 import os
 
 
+_TOKEN_RE = re.compile(r"\w+|[^\w\s]")
+# part of the vocab and encoded dataset file names: change it whenever tokenization changes, so that old files are
+# never reused
+TOKENIZER_VERSION = "re1"
+
+
+def tokenize(text):
+    """
+    Splits the text into words and single punctuation symbols.
+    """
+    return _TOKEN_RE.findall(text)
+
+
 def compute_binary_median_frequency_balancing(dataset):
 
     print("Computing class weights...")
-    num_tasks = len(dataset[0][1])
-    frequencies = np.zeros((num_tasks, 2))
-    for sample, targets in dataset:
-        for j, target in enumerate(targets.int()):
-            frequencies[j, target] += 1
+    # count negatives and positives of each task directly on the (N, num_tasks) target tensor
+    positives = (dataset.targets > 0).sum(dim=0).numpy()
+    frequencies = np.stack([len(dataset.targets) - positives, positives], axis=1).astype(np.float64)
 
     print(frequencies)
     positive_class_weights = frequencies[:, 0] / frequencies[:, 1]
@@ -31,55 +47,68 @@ class CollatePad(object):
         Collates groups of Tensors of variable lengths into one padded Tensor (for each group).
         :param batch: list of tuple of tensors (e.g. list of 32 tuples, where the first elements are inputs and the
         seconds are targets). Individual Tensors must be of shape (T, N1, N2, N3, ...) where T is the variable dimension
-        and N1, N2, N3, ... are any number of additional dimensions of fixed size. Inside the final Tensor, elements
-        will be sorted in descending order of length. IMPORTANT: if more than one group of Tensor has variable length,
-        it is assumed that the order according to length is consistent across groups, i.e. the variable lengths inside
-        the different groups of Tensor are equal along the same index in the group. Example: group 1 represents
-        tokenized sentences [["Hi", "Paolo", speaking"], ["Hi", "how", "are", "you", "today"]], group 2 POS tags
-        [[EXCL, NOM, VRB], [EXCL, ADV, BE, SUBJ, ADV]], lengths are consistent across groups thus the program can sort
-         according to the length of item of any attribute.
+        and N1, N2, N3, ... are any number of additional dimensions of fixed size. Elements keep their order inside the
+        batch (use enforce_sorted=False when packing the padded Tensors).
         :return: tuple of:
             * list of Tensors containing the padded batch, one for each group;
             * list of Tensors containing the variable lengths, one for each group.
         """
 
-        batch = sorted(batch, reverse=True, key=lambda elem: len(elem[0]))
-        variable_lengths = np.array([[tensor.shape[0] for tensor in tensors] for tensors in batch])
-        batch_size, num_tensors = variable_lengths.shape
-        max_lengths = np.max(variable_lengths, axis=0)
+        variable_lengths = torch.tensor([[tensor.shape[0] for tensor in tensors] for tensors in batch])
 
         padded_batch = []
         lengths = []
-        for group_index, max_length in enumerate(max_lengths):
-            tensors = [tensors[group_index] for tensors in batch]
-            single_tensor_shape = (max_length, *batch[0][group_index].shape[1:])
-            padded_tensor = torch.mul(torch.ones((batch_size, *single_tensor_shape), dtype=torch.long), self.pad_value)
-            for batch_index, length in enumerate(variable_lengths[:, group_index]):
-                padded_tensor[batch_index, :length] = tensors[batch_index]
-            padded_batch.append(padded_tensor)
-            lengths.append(torch.tensor(variable_lengths[:, group_index], dtype=torch.long))
+        for group_index, tensors in enumerate(zip(*batch)):
+            group_lengths = variable_lengths[:, group_index]
+            if bool((group_lengths == group_lengths[0]).all()):
+                padded_batch.append(torch.stack(tensors))
+            else:
+                padded_batch.append(pad_sequence(list(tensors), batch_first=True, padding_value=self.pad_value))
+            lengths.append(group_lengths)
         return padded_batch, lengths
 
 
-def compute_vocab(csv_file, dst_file, tokenizer=word_tokenize, max_size=65536):
+class BucketBatchSampler(Sampler):
+    """
+    Batch sampler grouping samples of similar length, to limit the padding inside each batch. Samples are sorted by
+    length and split into buckets of bucket_size batches; each bucket is shuffled and divided into batches, then the
+    order of all batches is shuffled.
+    """
+
+    def __init__(self, lengths, batch_size, bucket_size=100):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.bucket_size = bucket_size
+
+    def __iter__(self):
+        order = np.argsort(self.lengths, kind='stable')
+        samples_per_bucket = self.bucket_size * self.batch_size
+        batches = []
+        for start in range(0, len(order), samples_per_bucket):
+            bucket = np.random.permutation(order[start:start + samples_per_bucket])
+            batches.extend(bucket[i:i + self.batch_size].tolist() for i in range(0, len(bucket), self.batch_size))
+        for batch_index in np.random.permutation(len(batches)):
+            yield batches[batch_index]
+
+    def __len__(self):
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
+
+
+def compute_vocab(csv_file, dst_file, tokenizer=tokenize, max_size=65536):
 
     # load csv
-    with open(csv_file, 'r') as csvf:
-        csv_reader = csv.reader(csvf, delimiter=',')
-        rows = list(csv_reader)
+    texts = pd.read_csv(csv_file, usecols=[1], keep_default_na=False).iloc[:, 0]
 
     # compute vocab
-    all_words = [token for row in rows for token in map(lambda x: x.lower(), tokenizer(row[1]))]
-    occurrences = dict()
-    for word in all_words:
-        occurrences[word] = occurrences.get(word, 0) + 1
+    occurrences = Counter()
+    for text in texts:
+        occurrences.update(tokenizer(text.lower()))
     if max_size is None:
         max_size = len(occurrences)
 
-    vocab = set(map(lambda x: x[0], sorted(occurrences.items(), key=lambda x: x[1], reverse=True)[:max_size - 2]))
-    vocab.add('<PAD>')
-    vocab.add('<UNK>')
-    vocab = LabelIndexMap.from_list_of_labels(list(vocab), required_mappings={'<PAD>': 0, '<UNK>': 1})
+    # special tokens first, then words by decreasing frequency
+    labels = ['<PAD>', '<UNK>'] + [word for word, _ in occurrences.most_common(max_size - 2)]
+    vocab = LabelIndexMap.from_ordered_list(labels)
 
     # save vocab
     with open(dst_file, 'w') as f:
@@ -93,7 +122,6 @@ class LabelIndexMap(object):
     """
     def __init__(self, dict_of_values):
         self.label_to_index = dict_of_values
-        self.index_to_label = {index: label for label, index in dict_of_values.items()}
 
     @staticmethod
     def from_list_of_labels(all_labels, sort_key=None, required_mappings=None):
@@ -102,7 +130,8 @@ class LabelIndexMap(object):
         if sort_key is not None:
             individual_labels = sorted(all_labels, key=sort_key)
         if required_mappings is not None:
-            # set items to the required positions
+            # set items to the required positions, tracking the position of every label to avoid linear searches
+            positions = {label: i for i, label in enumerate(individual_labels)}
             for element, required_position in required_mappings.items():
                 if required_position >= len(individual_labels):
                     raise ValueError("Required position is out of range")
@@ -114,15 +143,34 @@ class LabelIndexMap(object):
                                                              required_position))
 
                 # swap
-                current_position = individual_labels.index(element)
+                current_position = positions[element]
                 individual_labels[current_position] = individual_labels[required_position]
                 individual_labels[required_position] = element
+                positions[individual_labels[current_position]] = current_position
+                positions[element] = required_position
 
         return LabelIndexMap({label: i for i, label in enumerate(individual_labels)})
 
+    @staticmethod
+    def from_ordered_list(labels):
+        """
+        Maps each label to its position in the list; labels must be unique.
+        """
+        label_to_index = {label: i for i, label in enumerate(labels)}
+        if len(label_to_index) != len(labels):
+            raise ValueError("Labels must be unique")
+        return LabelIndexMap(label_to_index)
+
     def __getitem__(self, item):
         return self.label_to_index[item]
 
+    def to_indices(self, labels, default_index):
+        """
+        Maps a list of labels to an int32 array of indices, using default_index for labels not in the map.
+        """
+        return np.fromiter(map(self.label_to_index.get, labels, repeat(default_index)), dtype=np.int32,
+                           count=len(labels))
+
     def __len__(self):
         return len(self.label_to_index)
 
@@ -141,45 +189,71 @@ class LabelIndexMap(object):
         return LabelIndexMap(dict_of_values=v)
 
 
+def encode_texts(texts, vocab: LabelIndexMap, tokenizer=tokenize):
+    """
+    Converts each lower-cased text into an int32 array of vocabulary indices (words not in the vocabulary are mapped to
+    '<UNK>').
+    """
+    print("Tokenizing {} texts...".format(len(texts)))
+    tokenized = [tokenizer(text.lower()) for text in texts]
+    offsets = np.cumsum([0] + [len(tokens) for tokens in tokenized])
+
+    # look up all tokens of the corpus at once, then split them back into texts
+    ids = vocab.to_indices(list(chain.from_iterable(tokenized)), default_index=vocab['<UNK>'])
+    return np.split(ids, offsets[1:-1])
+
+
+def save_encoded_dataset(filename, tokens, targets):
+    offsets = np.cumsum([0] + [len(ids) for ids in tokens], dtype=np.int32)
+    table = pa.table({
+        'tokens': pa.ListArray.from_arrays(pa.array(offsets), pa.array(np.concatenate(tokens), type=pa.int32())),
+        'targets': pa.FixedSizeListArray.from_arrays(pa.array(targets.ravel()), targets.shape[1])
+    })
+    feather.write_feather(table, filename)
+
+
+def load_encoded_dataset(filename):
+    table = feather.read_table(filename)
+    tokens = table.column('tokens').combine_chunks()
+    offsets = tokens.offsets.to_numpy()
+    ids = tokens.flatten().to_numpy(zero_copy_only=False, writable=True)
+    targets = table.column('targets').combine_chunks()
+    num_tasks = targets.type.list_size
+    targets = targets.flatten().to_numpy(zero_copy_only=False, writable=True).reshape(-1, num_tasks)
+    return np.split(ids, offsets[1:-1] - offsets[0]), targets
+
+
 class ToxicCommentDataset(Dataset):
 
-    def __init__(self, rows: list, vocab: LabelIndexMap, max_sequence_length=None):
+    def __init__(self, tokens: list, targets: np.ndarray, vocab: LabelIndexMap, max_sequence_length=None):
         # init
         self.vocab = vocab
         self.max_sequence_length = max_sequence_length
 
         if max_sequence_length is not None:
             assert isinstance(max_sequence_length, int)
+        assert len(tokens) == len(targets), "tokens and targets must have the same number of samples"
 
-        self.samples = []
-        for i, row in enumerate(rows):
-            print("Preparing dataset ({:6d}/{:6d})".format(i+1, len(rows)), end='\r')
-            text, classes = row[1], [float(x) for x in row[2:8]]
-            tokens = [self.vocab.label_to_index.get(token.lower(), self.vocab.label_to_index['<UNK>'])
-                      for token in word_tokenize(text)][:max_sequence_length]
-            self.samples.append((tokens, classes))
+        # samples are already encoded, so that fetching one is just indexing into pre-built tensors
+        self.tokens = [torch.from_numpy(ids[:max_sequence_length]) for ids in tokens]
+        self.targets = torch.from_numpy(np.ascontiguousarray(targets, dtype=np.float32))
 
     def __getitem__(self, index):
-        tokens, classes = self.samples[index]
-        return torch.tensor(tokens), torch.tensor(classes)
+        return self.tokens[index], self.targets[index]
+
+    def __getitems__(self, indices):
+        # used by DataLoader (torch>=1.13) to fetch a whole batch in one call
+        tokens, targets = self.tokens, self.targets[indices]
+        return [(tokens[index], target) for index, target in zip(indices, targets)]
 
     def __len__(self):
-        return len(self.samples)
+        return len(self.tokens)
 
 
 def produce_datasets(csv_file, max_dataset_size=None, max_sequence_length=None, vocab_size=65536, split_ratio=0.2):
 
-    # load csv
-    print("Loading CSV file '{}'...".format(csv_file))
-    with open(csv_file, 'r') as csvf:
-        csv_reader = csv.reader(csvf, delimiter=',')
-        rows = list(csv_reader)[1:]
-    if max_dataset_size is not None:
-        assert 0 < max_size < len(rows), "Invalid max_size"
-        rows = rows[:max_dataset_size]
-
     # load vocab
-    vocab_filename = "vocab_{}.txt".format(vocab_size)
+    vocab_filename = "vocab_{}_{}.txt".format(TOKENIZER_VERSION, vocab_size)
     vocab_path = os.path.join(os.path.dirname(csv_file), vocab_filename)
     if not os.path.exists(vocab_path):
         print("File '{}' not found. Computing vocab from training CSV file...".format(vocab_filename))
@@ -188,10 +262,28 @@ def produce_datasets(csv_file, max_dataset_size=None, max_sequence_length=None,
     print("Loading vocab file '{}'...".format(vocab_filename))
     vocab = LabelIndexMap.load(vocab_path)
 
+    # load encoded dataset, (re)building it if missing or older than the csv or the vocab
+    cache_filename = "encoded_{}_{}.feather".format(TOKENIZER_VERSION, vocab_size)
+    cache_path = os.path.join(os.path.dirname(csv_file), cache_filename)
+    if os.path.exists(cache_path) and \
+            os.path.getmtime(cache_path) >= max(os.path.getmtime(csv_file), os.path.getmtime(vocab_path)):
+        print("Loading encoded dataset '{}'...".format(cache_filename))
+        tokens, targets = load_encoded_dataset(cache_path)
+    else:
+        print("Loading CSV file '{}'...".format(csv_file))
+        df = pd.read_csv(csv_file, keep_default_na=False)
+        tokens = encode_texts(df.iloc[:, 1], vocab)
+        targets = df.iloc[:, 2:8].to_numpy(dtype=np.float32)
+        save_encoded_dataset(cache_path, tokens, targets)
+        print("Encoded dataset saved at '{}'.".format(cache_path))
+    if max_dataset_size is not None:
+        assert 0 < max_dataset_size < len(tokens), "Invalid max_dataset_size"
+        tokens, targets = tokens[:max_dataset_size], targets[:max_dataset_size]
+
     # produce datasets
-    train_size = int((1 - split_ratio) * len(rows))
-    train_set, test_set = ToxicCommentDataset(rows[:train_size], vocab, max_sequence_length), \
-                          ToxicCommentDataset(rows[train_size:], vocab, None)
+    train_size = int((1 - split_ratio) * len(tokens))
+    train_set, test_set = ToxicCommentDataset(tokens[:train_size], targets[:train_size], vocab, max_sequence_length), \
+                          ToxicCommentDataset(tokens[train_size:], targets[train_size:], vocab, None)
     return train_set, test_set
 
 
@@ -37,9 +37,9 @@ class RNNMultiBinaryClassificationNet(nn.Module):
         if additional_fc_layer is not None:
             assert isinstance(additional_fc_layer, int)
             self.fc = nn.Sequential(nn.Dropout(p_dropout), nn.Linear(hidden_size, additional_fc_layer),
-                                    nn.ReLU(), nn.Dropout(), nn.Linear(additional_fc_layer, num_tasks), nn.Sigmoid())
+                                    nn.ReLU(), nn.Dropout(), nn.Linear(additional_fc_layer, num_tasks))
         else:
-            self.fc = nn.Sequential(nn.Dropout(p_dropout), nn.Linear(hidden_size, num_tasks), nn.Sigmoid())
+            self.fc = nn.Sequential(nn.Dropout(p_dropout), nn.Linear(hidden_size, num_tasks))
 
         self.hidden_state = None
         self.reset_state()
@@ -49,7 +49,7 @@ class RNNMultiBinaryClassificationNet(nn.Module):
 
         bs, pad_length = batch.shape
         if actual_lengths is None:
-            actual_lengths = torch.tensor([pad_length]*bs, dtype=torch.long).to(self.device)
+            actual_lengths = torch.full((bs,), pad_length, dtype=torch.long)
 
         if reset_state:
             self.reset_state(bs=bs)
@@ -58,7 +58,7 @@ class RNNMultiBinaryClassificationNet(nn.Module):
 
         x = self.embedding(batch)
 
-        x = pack_padded_sequence(x, actual_lengths, batch_first=True)
+        x = pack_padded_sequence(x, actual_lengths, batch_first=True, enforce_sorted=False)
         z, self.hidden_state = self.gru(x, self.hidden_state)
         z, _ = pad_packed_sequence(z, batch_first=True)
         last_z = z[range(len(actual_lengths)), actual_lengths - 1, :]
@@ -67,4 +67,4 @@ class RNNMultiBinaryClassificationNet(nn.Module):
         return z
 
     def reset_state(self, bs=1):
-        self.hidden_state = torch.zeros((self.rnn_layers, bs, self.hidden_size)).to(self.device)
+        self.hidden_state = torch.zeros((self.rnn_layers, bs, self.hidden_size), device=self.device)
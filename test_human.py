@@ -1,10 +1,10 @@
 import torch
 from numpy import array
-from nltk.tokenize import word_tokenize
-from dataset import LabelIndexMap
+from dataset import LabelIndexMap, tokenize, TOKENIZER_VERSION
 
+# the model must have been trained with this vocab (same tokenizer version and vocab size)
 model_to_load = "loss=0.2414_f1=0.5478.pt"
-vocab_path = 'jigsaw-toxic-comment-classification-challenge/vocab.txt'
+vocab_path = 'jigsaw-toxic-comment-classification-challenge/vocab_{}_32768.txt'.format(TOKENIZER_VERSION)
 device = torch.device('cpu')
 thresholds = array([0.8, 0.98, 0.9, 0.99, 0.91, 0.97])
 
@@ -17,17 +17,23 @@ if __name__ == '__main__':
     model.device = device
     model.eval()
     model.to(device)
+    # older checkpoints end with a Sigmoid, newer ones output logits
+    outputs_probabilities = isinstance(model.fc[-1], torch.nn.Sigmoid)
 
     # load vocabulary
     vocab = LabelIndexMap.load(vocab_path)
+    assert len(vocab) == model.num_embeddings, "Vocab size does not match the model, check vocab_path"
 
     done = False
     while not done:
 
         input_text = input("Insert text:")
-        tokens = list(map(lambda tok: vocab.label_to_index.get(tok.lower(), vocab['<UNK>']), word_tokenize(input_text)))
-        input_tensor = torch.tensor(tokens, dtype=torch.long).to(device).unsqueeze(0)
-        output_tensor = model(input_tensor).detach().cpu().squeeze().numpy()
+        tokens = vocab.to_indices(tokenize(input_text.lower()), default_index=vocab['<UNK>'])
+        input_tensor = torch.from_numpy(tokens).to(device).unsqueeze(0)
+        output_tensor = model(input_tensor)
+        if not outputs_probabilities:
+            output_tensor = torch.sigmoid(output_tensor)
+        output_tensor = output_tensor.detach().cpu().squeeze().numpy()
         y_pred = (output_tensor > thresholds)
         print("Predictions:")
         for class_label, prob, class_predicted in zip(classes, output_tensor, y_pred):
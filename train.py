@@ -1,15 +1,16 @@
 import torch
 from torch.utils.data import DataLoader
 from torch.optim import Adam
-from torch import log
+from torch.nn.functional import binary_cross_entropy_with_logits
 import numpy as np
 import time
+import os
 from sys import argv
 from tensorboardX import SummaryWriter
 from argparse import ArgumentParser
 import pickle
 import datetime
-from dataset import produce_datasets, compute_binary_median_frequency_balancing, CollatePad
+from dataset import produce_datasets, compute_binary_median_frequency_balancing, CollatePad, BucketBatchSampler
 from nets import RNNMultiBinaryClassificationNet
 
 
@@ -17,6 +18,12 @@ precomputed_positive_class_weights = torch.tensor([9.41494656, 98.42056075, 17.8
                                                    329.71502591, 19.27895155, 115.05090909])
 
 
+def weighted_binary_cross_entropy(logits, targets, positive_class_weights):
+    # summed over tasks, averaged over samples
+    return binary_cross_entropy_with_logits(logits, targets, pos_weight=positive_class_weights,
+                                            reduction='sum') / len(targets)
+
+
 def load_data(args):
 
     np.random.seed(args.seed)
@@ -28,8 +35,18 @@ def load_data(args):
     args.vocab_size = len(ds_train.vocab)
     args.padding_idx = ds_train.vocab.label_to_index['<PAD>']
     collate_fn = CollatePad(pad_value=args.padding_idx)
-    train_loader = DataLoader(ds_train, shuffle=True, batch_size=args.bs, collate_fn=collate_fn)
-    test_loader = DataLoader(ds_test, shuffle=False, batch_size=args.bs_val, collate_fn=collate_fn)
+    loader_kwargs = dict(collate_fn=collate_fn, num_workers=args.num_workers, pin_memory=args.device.type == 'cuda')
+    if args.num_workers > 0:
+        loader_kwargs.update(persistent_workers=True, prefetch_factor=4)
+    # the test set is only read once per epoch: use fewer workers and don't keep them alive in between
+    test_loader_kwargs = dict(collate_fn=collate_fn, num_workers=min(2, args.num_workers),
+                              pin_memory=args.device.type == 'cuda')
+    if args.bucket_size > 0:
+        batch_sampler = BucketBatchSampler([len(tokens) for tokens in ds_train.tokens], args.bs, args.bucket_size)
+        train_loader = DataLoader(ds_train, batch_sampler=batch_sampler, **loader_kwargs)
+    else:
+        train_loader = DataLoader(ds_train, shuffle=True, batch_size=args.bs, **loader_kwargs)
+    test_loader = DataLoader(ds_test, shuffle=False, batch_size=args.bs_val, **test_loader_kwargs)
     if precomputed_positive_class_weights is not None:
         args.positive_class_weights = precomputed_positive_class_weights
     else:
@@ -54,6 +71,8 @@ def load_model(args):
 def train_evaluate(loaders: tuple, model: torch.nn.Module, optimizer: torch.optim.Optimizer, args):
 
     train_loader, test_loader = loaders
+    # the compiled module shares parameters with model, which is still the one saved and inspected
+    forward = torch.compile(model, fullgraph=False) if args.compile else model
     classification_thresholds = torch.tensor([0.83, 0.99, 0.92, 0.99, 0.93, 0.97]).to(args.device)
 
     experiment_folder = "./runs/{}".format(datetime.datetime.now())
@@ -61,6 +80,9 @@ def train_evaluate(loaders: tuple, model: torch.nn.Module, optimizer: torch.opti
     with open(experiment_folder + "/config.pkl", "wb") as f:
         pickle.dump(args, f)
 
+    use_amp = args.device.type == 'cuda' and not args.no_amp
+    scaler = torch.amp.GradScaler('cuda', enabled=use_amp)
+
     print("Starting training...")
     np.set_printoptions(4)
     best_test_loss = np.inf
@@ -69,26 +91,31 @@ def train_evaluate(loaders: tuple, model: torch.nn.Module, optimizer: torch.opti
 
         model.train()
         t_start = time.time()
+        running_loss = torch.zeros((), device=args.device)  # kept on device, read back only when logging
         for j, ((tokens, targets), (input_lengths, _)) in enumerate(train_loader):
 
             optimizer.zero_grad()
 
             # move to GPU
-            tokens = tokens.to(args.device)
-            targets = targets.float().to(args.device)
+            tokens = tokens.to(args.device, non_blocking=True)
+            targets = targets.to(args.device, non_blocking=True)
 
             # forward
-            output = model(tokens, input_lengths)
-            loss = -1/len(targets) * (args.positive_class_weights*targets*log(output) + (1-targets)*log(1-output)).sum()
-            loss_value = loss.item()
+            with torch.autocast(device_type=args.device.type, dtype=torch.float16, enabled=use_amp):
+                output = forward(tokens, input_lengths)
+                loss = weighted_binary_cross_entropy(output, targets, args.positive_class_weights)
+            running_loss += loss.detach()
 
             # backward
-            loss.backward()
+            scaler.scale(loss).backward()
 
             # update step
-            optimizer.step()
+            scaler.step(optimizer)
+            scaler.update()
 
             if (j + 1) % args.log_every == 0:
+                loss_value = running_loss.item() / args.log_every
+                running_loss.zero_()
                 writer.add_scalar("Loss/train", loss_value, global_step=epoch * len(train_loader) + j)
                 print("\rEpoch %3d/%3d, loss: %09.6f, "
                       "batch: %4d/%4d, pad length: %4d" % (epoch + 1, args.epochs, loss_value, j + 1,
@@ -101,31 +128,34 @@ def train_evaluate(loaders: tuple, model: torch.nn.Module, optimizer: torch.opti
                                                         classification_thresholds.cpu().numpy()), end='')
 
         model.eval()
-        test_loss = 0
-        total_correct = torch.zeros((6,))
-        total_true_positives = torch.zeros((6,))
-        total_false_positives = torch.zeros((6,))
-        total_real_positives = torch.zeros((6,))
-        for j, ((tokens, targets), (input_lengths, _)) in enumerate(test_loader):
-
-            # move to GPU
-            tokens = tokens.to(args.device)
-            targets = targets.float().to(args.device)
-            targets_b = targets.bool()
-
-            # forward
-            output = model(tokens, input_lengths)
-
-            # compute stats
-            y_pred = (output > classification_thresholds)
-            total_correct += (y_pred == targets_b).sum(dim=0).cpu().float()
-            total_true_positives += ((y_pred == 1) & (targets_b == 1)).sum(dim=0).cpu().float()
-            total_false_positives += ((y_pred == 1) & (targets_b == 0)).sum(dim=0).cpu().float()
-            total_real_positives += (targets_b == 1).sum(dim=0).cpu().float()
-            loss = -1/len(targets) * (args.positive_class_weights*targets*log(output) + (1-targets)*log(1-output)).sum()
-            test_loss += loss.item()
-
-        test_loss /= len(test_loader)
+        test_loss = torch.zeros((), device=args.device)
+        total_correct = torch.zeros((6,), dtype=torch.long, device=args.device)
+        total_true_positives = torch.zeros((6,), dtype=torch.long, device=args.device)
+        total_false_positives = torch.zeros((6,), dtype=torch.long, device=args.device)
+        total_real_positives = torch.zeros((6,), dtype=torch.long, device=args.device)
+        with torch.inference_mode():
+            for j, ((tokens, targets), (input_lengths, _)) in enumerate(test_loader):
+
+                # move to GPU
+                tokens = tokens.to(args.device, non_blocking=True)
+                targets = targets.to(args.device, non_blocking=True)
+                targets_b = targets.bool()
+
+                # forward
+                output = forward(tokens, input_lengths)
+
+                # compute stats
+                y_pred = (torch.sigmoid(output) > classification_thresholds)
+                total_correct += (y_pred == targets_b).sum(dim=0)
+                total_true_positives += ((y_pred == 1) & (targets_b == 1)).sum(dim=0)
+                total_false_positives += ((y_pred == 1) & (targets_b == 0)).sum(dim=0)
+                total_real_positives += (targets_b == 1).sum(dim=0)
+                test_loss += weighted_binary_cross_entropy(output, targets, args.positive_class_weights)
+
+        # single transfer back to the CPU
+        test_loss = test_loss.item() / len(test_loader)
+        total_correct, total_true_positives, total_false_positives, total_real_positives = \
+            torch.stack([total_correct, total_true_positives, total_false_positives, total_real_positives]).cpu()
         accuracies = (total_correct.numpy() / len(test_loader.dataset))
         precisions = (total_true_positives / (total_true_positives + total_false_positives)).numpy()
         recalls = (total_true_positives / total_real_positives).numpy()
@@ -134,8 +164,12 @@ def train_evaluate(loaders: tuple, model: torch.nn.Module, optimizer: torch.opti
 
         writer.add_scalar("Loss/test", test_loss, global_step=(epoch + 1) * len(train_loader))
         writer.add_scalar("F1/test/average", avg_f1_score, global_step=(epoch + 1))
-        writer.add_embedding(mat=model.embedding.weight.data, metadata=train_loader.dataset.vocab.label_to_index.keys(),
-                             global_step=(epoch + 1) * len(train_loader))
+        if (epoch + 1) % args.embedding_every == 0:
+            # versioned vocab files list words by decreasing frequency, so the first rows are the most frequent words
+            label_to_index = train_loader.dataset.vocab.label_to_index
+            labels = sorted(label_to_index, key=label_to_index.get)[:args.embedding_size]
+            writer.add_embedding(mat=model.embedding.weight.data[:len(labels)], metadata=labels,
+                                 global_step=(epoch + 1) * len(train_loader))
         print("\nEvaluation completed.\nTest loss:\t{:2.6f}\naccuracies:\t{}\nprecisions:\t{}\n"
               "recalls:\t{}\nF1 scores:\t{}".format(test_loss, accuracies, precisions, recalls, f1_scores))
 
@@ -170,18 +204,28 @@ if __name__ == '__main__':
     parser.add_argument("--dropout", default=0.0, type=float)
     parser.add_argument("--bs", default=32, type=int)
     parser.add_argument("--bs-val", default=256, type=int)
+    parser.add_argument("--bucket-size", default=100, type=int, help="batches per length bucket (0: no bucketing)")
     parser.add_argument("--embedding-dim", default=128, type=int)
     parser.add_argument("--rnn-sizes", default=[256, 256], type=int, nargs="+")
     parser.add_argument("--additional-fc", metavar="ADDITIONAL_FC_SIZE", default=None, type=int)
-    parser.add_argument("--log-every", type=int, default=1)
+    parser.add_argument("--log-every", type=int, default=50)
     parser.add_argument("--save-every", type=int, default=1)
+    parser.add_argument("--embedding-every", type=int, default=10)
+    parser.add_argument("--embedding-size", type=int, default=5000, help="number of most frequent words to project")
     parser.add_argument("--reload", metavar="MODEL", default=None, type=str)  # TODO
     parser.add_argument("--cpu", action="store_true")
+    parser.add_argument("--no-amp", action="store_true")
+    parser.add_argument("--compile", action="store_true",
+                        help="compile the model with torch.compile (PyTorch 2.x) and use TF32 matmuls")
+    parser.add_argument("--num-workers", type=int, default=min(8, os.cpu_count() or 1))
     parser.add_argument("--seed", type=int, default=0)
     arguments = parser.parse_args(argv[1:])
 
     assert all(s == arguments.rnn_sizes[0] for s in arguments.rnn_sizes[1:]), "Only equally-sized stacked LSTMs allowed"
     arguments.device = torch.device("cuda") if torch.cuda.is_available() and not arguments.cpu else torch.device("cpu")
+    torch.backends.cudnn.benchmark = True
+    if arguments.compile:
+        torch.set_float32_matmul_precision('high')
 
     data_loaders = load_data(arguments)
     model_, optimizer_ = load_model(arguments)